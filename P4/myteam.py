@@ -6,6 +6,10 @@ from pacai.core.directions import Directions
 import random
 import math
 
+# How far the score has to move since the roles were last worked out before TeamRoles works
+# them out again
+ROLE_SCORE_SWING = 5
+
 
 def createTeam(firstIndex, secondIndex, isRed,
         first = 'pacai.agents.capture.dummy.DummyAgent',
@@ -20,19 +24,218 @@ def createTeam(firstIndex, secondIndex, isRed,
     # firstAgent = reflection.qualifiedImport(first)
     # secondAgent = reflection.qualifiedImport(second)
 
-    # have to call the class since using qualified import wouldn't work in the server
+    # have to call the class since using qualified import wouldn't work in the server. Both
+    # agents share one TeamRoles, so they agree on who's attacking and who's defending
+    teamRoles = TeamRoles()
+
     return [
-        UngaBungaAgent(firstIndex),
-        UngaBungaAgent(secondIndex),
+        UngaBungaAgent(firstIndex, teamRoles = teamRoles),
+        UngaBungaAgent(secondIndex, teamRoles = teamRoles),
     ]
 
 
+class FoodClusters:
+    """
+    Splits the food into clusters, groups of pellets where every pellet is at most
+    `linkDistance` maze steps from another pellet in the same group, and keeps track of each
+    cluster's size and centroid (the pellet closest to the middle of the cluster).
+
+    The pellets that are close enough to link up are worked out once per layout. After that,
+    `update` only regroups the clusters that actually lost a pellet, and the biggest cluster is
+    kept on hand so the feature can read it without looking at the food at all.
+    """
+
+    def __init__(self, foodList, distanceFunction, linkDistance = 2):
+        self.distanceFunction = distanceFunction
+        self.linkDistance = linkDistance
+        self._build(foodList)
+
+    def _build(self, foodList):
+        """
+        Links every pair of pellets that are close enough and groups the whole food list.
+        """
+        self.food = set(foodList)
+        self.links = {pellet: [] for pellet in self.food}
+        for pellet in self.food:
+            for other in self.food:
+                if pellet != other and self.distanceFunction(pellet, other) <= self.linkDistance:
+                    self.links[pellet].append(other)
+
+        self.clusterOf = {}
+        self.clusters = {}
+        self.centroids = {}
+        self._nextId = 0
+        self._group(self.food)
+
+    def _group(self, pellets):
+        """
+        Splits the pellets into connected clusters and gives each one a new id.
+        """
+        unvisited = set(pellets)
+        while len(unvisited) > 0:
+            start = unvisited.pop()
+            members = {start}
+            frontier = [start]
+            while len(frontier) > 0:
+                pellet = frontier.pop()
+                for other in self.links[pellet]:
+                    if other in unvisited:
+                        unvisited.discard(other)
+                        members.add(other)
+                        frontier.append(other)
+
+            clusterId = self._nextId
+            self._nextId += 1
+            self.clusters[clusterId] = members
+            self.centroids[clusterId] = self._centroid(members)
+            for pellet in members:
+                self.clusterOf[pellet] = clusterId
+
+        self.largest = max(self.clusters, key = lambda c: len(self.clusters[c]), default = None)
+
+    def _centroid(self, members):
+        """
+        Returns the pellet closest to the average position of the cluster.
+        """
+        averageX = sum(pellet[0] for pellet in members) / len(members)
+        averageY = sum(pellet[1] for pellet in members) / len(members)
+        return min(members, key = lambda p: (abs(p[0] - averageX) + abs(p[1] - averageY), p))
+
+    def update(self, foodList):
+        """
+        Catches the clusters up with the food that's left. Eaten pellets are taken out of their
+        cluster and only that cluster is regrouped, since it might have split in two. If food
+        ever shows up somewhere new, everything is rebuilt.
+        """
+        food = set(foodList)
+        if food == self.food:
+            return
+
+        if not food <= self.food:
+            self._build(food)
+            return
+
+        changed = set()
+        for pellet in self.food - food:
+            changed.add(self.clusterOf.pop(pellet))
+            for other in self.links.pop(pellet):
+                self.links[other].remove(pellet)
+
+        self.food = food
+        leftovers = set()
+        for clusterId in changed:
+            leftovers |= self.clusters.pop(clusterId) & food
+            del self.centroids[clusterId]
+
+        self._group(leftovers)
+
+    def largestCentroid(self):
+        """
+        Returns the centroid of the biggest cluster, or None if there's no food left.
+        """
+        if self.largest is None:
+            return None
+
+        return self.centroids[self.largest]
+
+
+class TeamRoles:
+    """
+    Which of our agents attacks and which defends. Both agents on the team share one of these
+    (createTeam hands it to them), so the roles are worked out in one place: once when the game
+    starts, and after that only when something happens that could change them, like losing a
+    capsule we were defending, a big swing in the score or one of us getting eaten. `roles`
+    maps each of our agent indexes to OFFENSE or DEFENSE, the same values as the onDefense
+    feature.
+    """
+
+    OFFENSE = 0
+    DEFENSE = 1
+
+    def __init__(self):
+        self.roles = {}
+        self.team = None
+        self._starts = {}
+        self._positions = {}
+        self._capsules = None
+        self._score = None
+
+    def register(self, agent, gameState):
+        """
+        Works out the roles at the start of the game. Only the first agent to register does
+        anything, the second one gets the same roles.
+        """
+        if self.team is not None:
+            return
+
+        self.team = agent.getTeam(gameState)
+        for index in self.team:
+            self._starts[index] = gameState.getAgentState(index).getPosition()
+            self._positions[index] = self._starts[index]
+        self._assign(agent, gameState)
+
+    def update(self, agent, gameState):
+        """
+        Checks the state an agent is about to move from and works the roles out again if we
+        lost a capsule, the score moved by ROLE_SCORE_SWING or more, or one of us got sent back
+        to the start since the last check.
+        """
+        died = False
+        for index in self.team:
+            position = gameState.getAgentState(index).getPosition()
+            if position == self._starts[index] and self._positions[index] != position:
+                died = True
+            self._positions[index] = position
+
+        capsules = len(agent.getCapsulesYouAreDefending(gameState))
+        score = agent.getScore(gameState)
+        if died or capsules != self._capsules or abs(score - self._score) >= ROLE_SCORE_SWING:
+            self._assign(agent, gameState)
+
+    def _assign(self, agent, gameState):
+        """
+        Works out every agent's role from the state.
+        """
+        # ALGORITHM GOAL: to assign each agent on the team to either offense or defense
+        # IMPLEMENTATION: goes through our team in order. The first agent in the team list is
+        # assigned to offense, next player to defense and so on. If we've lost every capsule
+        # we were defending there's nothing left to guard them for, so everyone goes on offense
+        # VARIABLES USED:
+        # count - which place in the team list the agent is in
+        # capsules - how many capsules we still have to defend
+        capsules = len(agent.getCapsulesYouAreDefending(gameState))
+        for count, index in enumerate(self.team):
+            if count % 2 == 1 and capsules > 0:
+                self.roles[index] = self.DEFENSE
+            else:
+                self.roles[index] = self.OFFENSE
+
+        self._capsules = capsules
+        self._score = agent.getScore(gameState)
+
+
 class UngaBungaAgent(CaptureAgent):
 
     # initializes Our Ungabunga agent, nothing to fancy, don't have to make any changes to init
     def __init__(self, index, **kwargs):
         super().__init__(index)
         self.lava_floor = 0
+        self.foodClusters = None
+
+        # who's on offense and who's on defense, shared with our teammate when createTeam
+        # made us (otherwise we keep our own)
+        self.teamRoles = kwargs.get('teamRoles')
+        if self.teamRoles is None:
+            self.teamRoles = TeamRoles()
+
+    def registerInitialState(self, gameState):
+        """
+        Groups the food we're attacking into clusters and works out the roles once at the
+        start of the game.
+        """
+        super().registerInitialState(gameState)
+        self.foodClusters = FoodClusters(self.getFood(gameState).asList(), self.getMazeDistance)
+        self.teamRoles.register(self, gameState)
 
     # takes a list of legal actions, and chooses the action that maximizes score based on the
     # current features the agent has. Scores are calculated by multiplying features by weights
@@ -52,6 +255,11 @@ class UngaBungaAgent(CaptureAgent):
         scores = {}
         bestActions = []
 
+        # catch the food clusters up with whatever got eaten since our last turn, and check if
+        # anything happened that changes who's attacking and who's defending
+        self.foodClusters.update(self.getFood(gameState).asList())
+        self.teamRoles.update(self, gameState)
+
         # ALGORITHM GOAL: to loop through available actions and evaluate the actions value
         # IMPLEMENTATION: Calls our list of legalMoves and iterates through each action. Each
         # action is then assigned to our scores dictionary with its given value.
@@ -100,9 +308,11 @@ class UngaBungaAgent(CaptureAgent):
         # weights - a dictionary that holds our weights per feature
         # FUNCTIONS CALLED:
         # self.getFeatures - returns a dictionary of features given a state and action
-        # self.getWeights - returns a dictionary of weights given a state and action
+        # self.getWeights - returns a dictionary of weights given a state and action, we hand
+        # it the features we just computed so that getFeatures (which generates a successor
+        # and advances the lava_floor counter) only runs once per action
         features = self.getFeatures(gameState, action)
-        weights = self.getWeights(gameState, action)
+        weights = self.getWeights(gameState, action, features)
 
         # RETURNED: Now that we have our features and weights we multiply them and add them
         # together to return a value. When you multiply two dictionaries together, we multiply
@@ -123,46 +333,13 @@ class UngaBungaAgent(CaptureAgent):
         # myState - an agents state given a successor state
         # myPos - an agents coordinates in (x,y) format for that successor state
         # features['onDefense] - tells the agent whether they are playing offense (0) or
-        # playing defense (1), defaults to offense so that we always have at least one attacker
-        # currentTeam - a list of agents (and their indexes) on our agent's team
-        # aSide - a list of agents that will be playing offense (0)
-        # bSide - a list of agents that will be playing defense (1)
+        # playing defense (1), read from the roles our TeamRoles worked out
         features = counter.Counter()
         successor = gameState.generateSuccessor(self.index, action)
         features['successorScore'] = self.getScore(successor)
         myState = successor.getAgentState(self.index)
         myPos = myState.getPosition()
-        features['onDefense'] = 0
-        currentTeam = self.getTeam(gameState)
-
-        aSide = []
-        bSide = []
-
-        # ALGORITHM GOAL: to assign each agent on the team to either offense or defense
-        # IMPLEMENTATION: creates a while loop that iterates through our team. Count keeps
-        # track of which agent in the team list we're on. Since our indexes for each agent
-        # will be varying numbers, we keep track of their placement on the team to assign
-        # them to offense or defense. The first agent in the currentTeam list is assigned
-        # to offense, next player to defense and so on. We use a modulo to check if which
-        # index they're in to keep track of players being sent to offense or defense. After
-        # being added to either aSide or bSide, the features of the agent are updated.
-        # VARIABLES USED:
-        # count - integer that will keep track of which index the agent is on
-        # teamLength - length of the team
-        # bSide - our list of defense agents
-        # aSide - our list of offense agents
-        count = 1
-        while count <= len(currentTeam):
-            if count % 2 == 0:
-                bSide.append(currentTeam[count - 1])
-            else:
-                aSide.append(currentTeam[count - 1])
-            count += 1
-
-        if self.index in aSide:
-            features['onDefense'] = 0
-        else:
-            features['onDefense'] = 1
+        features['onDefense'] = self.teamRoles.roles[self.index]
 
         # ALGORITHM GOAL: to create a variable that keeps track of our teams food vs their team
         # and to get the X and Y values of the entire map
@@ -190,10 +367,6 @@ class UngaBungaAgent(CaptureAgent):
         theirFoodCount = 0
         layoutX = -2
 
-        capsule = self.getCapsulesYouAreDefending(gameState)
-        if len(capsule) == 0:
-            features['onDefense'] = 0
-
         for foods in ourFoodPosition:
             layoutX += 1
             layoutY = -2
@@ -254,10 +427,11 @@ class UngaBungaAgent(CaptureAgent):
                 minDistance = min([self.getMazeDistance(myPos, big_fruit) for big_fruit in capsules])
                 features['distanceToCapsule'] = minDistance
 
-            for food1 in foodList:
-                for food2 in foodList:
-                    ClusterDist = self.getMazeDistance(food1, food2)
-                    if ClusterDist < 3: features['foodCluster'] = ClusterDist
+            # Head towards the biggest group of pellets (pellets within 2 steps of each other)
+            # so one trip over the border can grab a lot of food
+            clusterCentroid = self.foodClusters.largestCentroid()
+            if clusterCentroid is not None:
+                features['foodCluster'] = self.getMazeDistance(myPos, clusterCentroid)
 
             
 
@@ -361,7 +535,7 @@ class UngaBungaAgent(CaptureAgent):
 
             return features
 
-    def getWeights(self, gameState, action):
+    def getWeights(self, gameState, action, features = None):
         """
         Returns a dict of weights for the state.
         The keys match up with the return from `ReflexCaptureAgent.getFeatures`.
@@ -377,7 +551,10 @@ class UngaBungaAgent(CaptureAgent):
         # The rest of the weights prioritize higher values
         # EX: inTeamSide: 150 - as a defender, staying in team side is worth more points than
         # going into enemy territory
-        features = self.getFeatures(gameState, action)
+        # The weight table is picked from the features' onDefense value. evaluate passes in
+        # the features it already has, we only compute them here if we're called on our own.
+        if features is None:
+            features = self.getFeatures(gameState, action)
         if features['onDefense'] == 0:
             return {'successorScore': 100, 'distanceToFood': -5, 'numInvaders': -1500,
                     'invaderDistance': -500, 'distanceToCapsule':-2, 'DangerousEnemyDistance': 1,
@@ -98,9 +98,11 @@ class UngaBungaAgent(CaptureAgent):
         # weights - a dictionary that holds our weights per feature
         # FUNCTIONS CALLED:
         # self.getFeatures - returns a dictionary of features given a state and action
-        # self.getWeights - returns a dictionary of weights given a state and action
+        # self.getWeights - returns a dictionary of weights given a state and action, we hand
+        # it the features we just computed so that getFeatures (which generates a successor)
+        # only runs once per action
         features = self.getFeatures(gameState, action)
-        weights = self.getWeights(gameState, action)
+        weights = self.getWeights(gameState, action, features)
 
         # RETURNED: Now that we have our features and weights we multiply them and add them
         # together to return a value. When you multiply two dictionaries together, we multiply
@@ -311,7 +313,7 @@ class UngaBungaAgent(CaptureAgent):
 
             return features
 
-    def getWeights(self, gameState, action):
+    def getWeights(self, gameState, action, features = None):
         """
         Returns a dict of weights for the state.
         The keys match up with the return from `ReflexCaptureAgent.getFeatures`.
@@ -327,7 +329,10 @@ class UngaBungaAgent(CaptureAgent):
         # The rest of the weights prioritize higher values
         # EX: inTeamSide: 150 - as a defender, staying in team side is worth more points than
         # going into enemy territory
-        features = self.getFeatures(gameState, action)
+        # The weight table is picked from the features' onDefense value. evaluate passes in
+        # the features it already has, we only compute them here if we're called on our own.
+        if features is None:
+            features = self.getFeatures(gameState, action)
         if features['onDefense'] == 0:
             return {'successorScore': 100, 'distanceToFood': -1, 'numInvaders': -1500,
                     'invaderDistance': -500}
@@ -1,9 +1,61 @@
 # from pacai.util import reflection
 from pacai.agents.capture.capture import CaptureAgent
-from pacai.util import counter
 from pacai.core.directions import Directions
+from array import array
+import collections
+import hashlib
+import mmap
+import operator
+import os
 import random
 import math
+import struct
+import sys
+import tempfile
+import time
+
+# Where DistanceTable saves the distance tables it builds, set to None to turn the cache off
+DISTANCE_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'ungabunga_distances')
+
+# Seconds the contest gives us to pick a move, and how much of that we keep in reserve so we
+# can always hand an action back in time
+MOVE_TIME_LIMIT = 1.0
+MOVE_SAFETY_MARGIN = 0.1
+
+# How many successor states an agent keeps around during one turn
+SUCCESSOR_CACHE_SIZE = 2000
+
+# How much MCTSAgent favours trying moves it hasn't looked at much over the ones that look best
+# so far, and how many random moves a playout makes before the evaluation function scores it
+MCTS_EXPLORATION = math.sqrt(2)
+MCTS_ROLLOUT_DEPTH = 6
+
+# How far the score has to move since the roles were last worked out before TeamRoles works
+# them out again
+ROLE_SCORE_SWING = 5
+
+# The contest's noisy enemy distances are the real (manhattan) distance plus a random number
+# from -SONAR_NOISE to SONAR_NOISE, and enemies within SIGHT_RANGE of one of us are visible
+SONAR_NOISE = 6
+SIGHT_RANGE = 5
+
+# How close a ghost that can eat us has to get before our attacker starts heading back home
+RETREAT_DISTANCE = 3
+
+# Every feature getFeatures can set, in the order FeatureVector and the weight vectors keep them
+FEATURE_COLUMNS = ('successorScore', 'onDefense', 'mapX', 'mapY', 'DangerousEnemyDistance',
+        'closestEnemy', 'distanceToFood', 'distanceToCapsule', 'foodCluster', 'distanceHome',
+        'numInvaders', 'ourFloorIsLava', 'invaderDistance', 'numPotentialInvaders', 'inTeamSide',
+        'witnessMEEEE', 'potentialInvaderDistance', 'stop', 'reverse')
+
+# The weights for each role, getWeights picks one based on the onDefense feature (see there
+# for what they mean)
+OFFENSE_WEIGHTS = {'successorScore': 100, 'distanceToFood': -5, 'numInvaders': -1500,
+        'invaderDistance': -500, 'distanceToCapsule':-2, 'DangerousEnemyDistance': 1,
+        'ourFloorIsLava': -1, 'closestEnemy':2, 'foodCluster': -2, 'distanceHome': -4}
+DEFENSE_WEIGHTS = {'numInvaders': -1500, 'onDefense': 100, 'invaderDistance': -500,
+        'potentialInvaderDistance': -5, 'stop': -100, 'reverse': -10,
+        'inTeamSide': 150, 'witnessMEEEE': -1250}
 
 
 def createTeam(firstIndex, secondIndex, isRed,
@@ -19,19 +71,1268 @@ def createTeam(firstIndex, secondIndex, isRed,
     # firstAgent = reflection.qualifiedImport(first)
     # secondAgent = reflection.qualifiedImport(second)
 
-    # have to call the class since using qualified import wouldn't work in the server
+    # have to call the class since using qualified import wouldn't work in the server, so we
+    # look the agent up by its class name in TEAM_AGENTS instead. Anything we don't have (like
+    # the default DummyAgent) gets an UngaBungaAgent
+    firstAgent = TEAM_AGENTS.get(first.split('.')[-1], UngaBungaAgent)
+    secondAgent = TEAM_AGENTS.get(second.split('.')[-1], UngaBungaAgent)
+
+    # both agents share one TeamBlackboard, so everything about the map, the roles and where
+    # the enemies are is only worked out once for the team
+    blackboard = TeamBlackboard()
+
     return [
-        UngaBungaAgent(firstIndex),
-        UngaBungaAgent(secondIndex),
+        firstAgent(firstIndex, blackboard = blackboard),
+        secondAgent(secondIndex, blackboard = blackboard),
     ]
 
 
+class LayoutInfo:
+    """
+    Map geometry that stays the same for a whole game. It's built once in
+    `UngaBungaAgent.registerInitialState` so the features can just read it.
+    """
+
+    def __init__(self, gameState, red):
+        walls = gameState.getWalls()
+
+        # width and height of the whole grid, walls included
+        self.width = walls.getWidth()
+        self.height = walls.getHeight()
+
+        # largest X and Y an agent can actually be in, every layout has a wall all the way
+        # around it so these are 2 smaller than the grid
+        self.layoutX = self.width - 2
+        self.layoutY = self.height - 2
+
+        # the midline column, red owns every column left of it and blue owns it and every
+        # column to the right
+        self.red = red
+        self.midX = self.width // 2
+
+        # our last column before the midline and its open cells, the spots where we cross into
+        # enemy territory and where we're safe again on the way back
+        self.borderX = self.midX - 1 if red else self.midX
+        self.borderCells = [(self.borderX, y) for y in range(self.height)
+                if not walls[self.borderX][y]]
+
+    def isHome(self, position, margin = 0):
+        """
+        Returns True if the position is on our side of the map. A positive `margin` counts
+        that many columns past the midline as ours too, a negative one leaves out that many of
+        our columns next to it.
+        """
+        if self.red:
+            return int(position[0]) < self.midX + margin
+
+        return int(position[0]) >= self.midX - margin
+
+
+class DistanceTable:
+    """
+    Maze distance between every pair of open cells in the layout.
+
+    Every open cell gets a small integer id (`cellIds`), and the distances live in one flat
+    `array('H')` (unsigned 16 bit) of size cells * cells, so the distance from cell i to cell j
+    is `distances[i * size + j]`. At 2 bytes a pair even a 10^5 entry table is only a few
+    hundred KB, a lot smaller than a dict of position pairs.
+
+    If `cacheDir` is given, the table is also saved there in a file named after a hash of the
+    walls. The next game on the same layout memory maps that file instead of running all the
+    searches again, which takes milliseconds instead of most of our setup time.
+
+    It also keeps every cell's legal moves, as (action, neighbor cell id) pairs in two flat
+    arrays: `moveActions` holds the action codes (indexes into ACTIONS) and `moveTargets` the
+    cells they lead to, and cell i's moves are the slots from `moveStarts[i]` up to
+    `moveStarts[i + 1]`. Stopping is one of them, it leads back to the same cell.
+    `getLegalActions` hands out each cell's actions ready made, so asking is a lookup.
+    """
+
+    UNREACHABLE = 0xFFFF
+
+    # every action in the order the game lists them, and the way each one moves you
+    ACTIONS = (Directions.NORTH, Directions.SOUTH, Directions.EAST, Directions.WEST,
+            Directions.STOP)
+    ACTION_VECTORS = ((0, 1), (0, -1), (1, 0), (-1, 0), (0, 0))
+
+    # file header: a magic tag and the number of cells, followed by the raw table
+    CACHE_HEADER = struct.Struct('<4sI')
+    CACHE_MAGIC = b'UBDT'
+
+    def __init__(self, walls, cacheDir = None):
+        width = walls.getWidth()
+        height = walls.getHeight()
+
+        # every cell that isn't a wall, numbered column by column
+        self.cells = [(x, y) for x in range(width) for y in range(height) if not walls[x][y]]
+        self.cellIds = {cell: i for i, cell in enumerate(self.cells)}
+        self.size = len(self.cells)
+
+        # the open cells you can step to from each cell
+        self.neighbors = []
+        for (x, y) in self.cells:
+            around = [(x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)]
+            self.neighbors.append([self.cellIds[cell] for cell in around if cell in self.cellIds])
+
+        # the legal moves out of each cell, and the actions for them
+        self.moveStarts = array('I', [0])
+        self.moveActions = array('B')
+        self.moveTargets = array('H')
+        self.legalActions = []
+        for (x, y) in self.cells:
+            first = len(self.moveActions)
+            for code, (dx, dy) in enumerate(self.ACTION_VECTORS):
+                target = self.cellIds.get((x + dx, y + dy))
+                if target is not None:
+                    self.moveActions.append(code)
+                    self.moveTargets.append(target)
+            self.moveStarts.append(len(self.moveActions))
+            self.legalActions.append(tuple(self.ACTIONS[code]
+                    for code in self.moveActions[first:]))
+
+        self.cachePath = None
+        if cacheDir is not None:
+            self.cachePath = os.path.join(cacheDir, self.layoutKey(walls) + '.dist')
+
+        self.distances = self._loadCache()
+        if self.distances is None:
+            self.distances = array('H', [self.UNREACHABLE]) * (self.size * self.size)
+            for source in range(self.size):
+                self._search(source)
+            self._saveCache()
+
+    @staticmethod
+    def layoutKey(walls):
+        """
+        Returns a hash of the wall grid, two layouts get the same key only if they have the
+        exact same walls. The byte order is mixed in since the table is saved as raw memory.
+        """
+        width = walls.getWidth()
+        height = walls.getHeight()
+        bits = bytes(walls[x][y] for x in range(width) for y in range(height))
+
+        key = hashlib.sha1()
+        key.update(struct.pack('<II', width, height))
+        key.update(bits)
+        key.update(sys.byteorder.encode())
+        return key.hexdigest()
+
+    def _loadCache(self):
+        """
+        Memory maps a saved table for this layout, returns None if there isn't a usable one.
+        """
+        if self.cachePath is None:
+            return None
+
+        try:
+            with open(self.cachePath, 'rb') as file:
+                mapped = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        header = self.CACHE_HEADER.size
+        expected = header + 2 * self.size * self.size
+        magic, size = self.CACHE_HEADER.unpack_from(mapped) if len(mapped) >= header else (b'', 0)
+        if magic != self.CACHE_MAGIC or size != self.size or len(mapped) != expected:
+            mapped.close()
+            return None
+
+        # a view straight onto the mapped file, nothing gets copied
+        self._mapped = mapped
+        return memoryview(mapped)[header:].cast('H')
+
+    def _saveCache(self):
+        """
+        Writes the table out for later games. The file is written under a temporary name and
+        then renamed, so another game reading the cache never sees half a table.
+        """
+        if self.cachePath is None:
+            return
+
+        try:
+            directory = os.path.dirname(self.cachePath)
+            os.makedirs(directory, exist_ok = True)
+            handle, tempPath = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+            with os.fdopen(handle, 'wb') as file:
+                file.write(self.CACHE_HEADER.pack(self.CACHE_MAGIC, self.size))
+                self.distances.tofile(file)
+            os.replace(tempPath, self.cachePath)
+        except OSError:
+            # not being able to save just means the next game builds the table again
+            pass
+
+    def _search(self, source):
+        """
+        Breadth first search out of one cell, filling in that cell's row of the table.
+        """
+        distances = self.distances
+        neighbors = self.neighbors
+        row = source * self.size
+
+        distances[row + source] = 0
+        frontier = [source]
+        steps = 0
+        while len(frontier) > 0:
+            steps += 1
+            nextFrontier = []
+            for cell in frontier:
+                for neighbor in neighbors[cell]:
+                    if distances[row + neighbor] == self.UNREACHABLE:
+                        distances[row + neighbor] = steps
+                        nextFrontier.append(neighbor)
+            frontier = nextFrontier
+
+    def getDistance(self, pos1, pos2):
+        """
+        Returns the maze distance between two positions, or None if either one isn't an open
+        cell on the grid or there's no path between them.
+        """
+        first = self.cellIds.get(pos1)
+        second = self.cellIds.get(pos2)
+        if first is None or second is None:
+            return None
+
+        distance = self.distances[first * self.size + second]
+        if distance == self.UNREACHABLE:
+            return None
+
+        return distance
+
+    def getLegalActions(self, position):
+        """
+        Returns the actions an agent on the position can take, in the order the game lists
+        them, or None if the position isn't an open cell.
+        """
+        cell = self.cellIds.get(position)
+        if cell is None:
+            return None
+
+        return self.legalActions[cell]
+
+
+class DistanceField:
+    """
+    Distance from every open cell to the closest of a set of source cells, found with one
+    breadth first search that starts from all the sources at once. Looking up how far a cell
+    is from the nearest source is then a single array read.
+    """
+
+    def __init__(self, table, sources):
+        self.table = table
+        self.sources = frozenset(sources)
+        self.distances = array('H', [DistanceTable.UNREACHABLE]) * table.size
+
+        frontier = []
+        for source in self.sources:
+            cell = table.cellIds.get(source)
+            if cell is not None and self.distances[cell] != 0:
+                self.distances[cell] = 0
+                frontier.append(cell)
+
+        steps = 0
+        while len(frontier) > 0:
+            steps += 1
+            nextFrontier = []
+            for cell in frontier:
+                for neighbor in table.neighbors[cell]:
+                    if self.distances[neighbor] == DistanceTable.UNREACHABLE:
+                        self.distances[neighbor] = steps
+                        nextFrontier.append(neighbor)
+            frontier = nextFrontier
+
+    def getDistance(self, position):
+        """
+        Returns the distance from the position to the closest source, or None if there isn't
+        one we can reach.
+        """
+        cell = self.table.cellIds.get(position)
+        if cell is None or self.distances[cell] == DistanceTable.UNREACHABLE:
+            return None
+
+        return self.distances[cell]
+
+
+class TargetIndex:
+    """
+    Keeps track of how far every cell is from the closest of a set of targets, like the food
+    we're trying to eat or the capsules we want to grab.
+
+    `update` is given the targets left at the start of a turn and only redoes the search when
+    they have actually changed. If `eatenOnArrival` is set, stepping onto a target removes it,
+    so `nearestFrom` answers for the targets that are left after the move. The field without
+    that one target is built the first time it's asked for and kept until the targets change.
+    The fields for the last few sets of targets are kept too, so going back and forth between
+    states (like a lookahead does) doesn't redo the searches.
+    """
+
+    RECENT_FIELDS = 32
+
+    def __init__(self, table, eatenOnArrival = True):
+        self.table = table
+        self.eatenOnArrival = eatenOnArrival
+        self.targets = frozenset()
+        self.field = DistanceField(table, self.targets)
+        self._fieldsWithout = {}
+        self._recent = collections.OrderedDict()
+
+    def update(self, targetList):
+        """
+        Switches the index over to the given targets if they're different from last time.
+        """
+        targets = frozenset(targetList)
+        if targets == self.targets:
+            return
+
+        self._recent[self.targets] = (self.field, self._fieldsWithout)
+        cached = self._recent.pop(targets, None)
+        if cached is None:
+            cached = (DistanceField(self.table, targets), {})
+        while len(self._recent) > self.RECENT_FIELDS:
+            self._recent.popitem(last = False)
+
+        self.targets = targets
+        self.field, self._fieldsWithout = cached
+
+    def nearestFrom(self, position):
+        """
+        Returns the maze distance from the position to the closest target still left once we're
+        standing there, or None if there isn't one left.
+        """
+        if not self.eatenOnArrival or position not in self.targets:
+            return self.field.getDistance(position)
+
+        field = self._fieldsWithout.get(position)
+        if field is None:
+            field = DistanceField(self.table, self.targets - {position})
+            self._fieldsWithout[position] = field
+
+        return field.getDistance(position)
+
+
+class FoodClusters:
+    """
+    Splits the food into clusters, groups of pellets where every pellet is at most
+    `linkDistance` maze steps from another pellet in the same group, and keeps track of each
+    cluster's size and centroid (the pellet closest to the middle of the cluster).
+
+    The pellets that are close enough to link up are worked out once per layout (and kept for
+    every pellet we've ever seen). After that, `update` only regroups the clusters that gained
+    or lost a pellet, and the biggest cluster is kept on hand so the feature can read it
+    without looking at the food at all.
+    """
+
+    def __init__(self, foodList, distanceFunction, linkDistance = 2):
+        self.distanceFunction = distanceFunction
+        self.linkDistance = linkDistance
+        self.links = {}
+        for pellet in foodList:
+            self._link(pellet)
+
+        self.food = set(foodList)
+        self.clusterOf = {}
+        self.clusters = {}
+        self.centroids = {}
+        self._nextId = 0
+        self._group(self.food)
+
+    def _link(self, pellet):
+        """
+        Links a pellet we haven't seen before with every known pellet that's close enough.
+        """
+        self.links[pellet] = []
+        for other in self.links:
+            if other != pellet and self.distanceFunction(pellet, other) <= self.linkDistance:
+                self.links[pellet].append(other)
+                self.links[other].append(pellet)
+
+    def _group(self, pellets):
+        """
+        Splits the pellets into connected clusters and gives each one a new id.
+        """
+        unvisited = set(pellets)
+        while len(unvisited) > 0:
+            start = unvisited.pop()
+            members = {start}
+            frontier = [start]
+            while len(frontier) > 0:
+                pellet = frontier.pop()
+                for other in self.links[pellet]:
+                    if other in unvisited:
+                        unvisited.discard(other)
+                        members.add(other)
+                        frontier.append(other)
+
+            clusterId = self._nextId
+            self._nextId += 1
+            self.clusters[clusterId] = members
+            self.centroids[clusterId] = self._centroid(members)
+            for pellet in members:
+                self.clusterOf[pellet] = clusterId
+
+        self.largest = max(self.clusters, key = lambda c: len(self.clusters[c]), default = None)
+
+    def _centroid(self, members):
+        """
+        Returns the pellet closest to the average position of the cluster.
+        """
+        averageX = sum(pellet[0] for pellet in members) / len(members)
+        averageY = sum(pellet[1] for pellet in members) / len(members)
+        return min(members, key = lambda p: (abs(p[0] - averageX) + abs(p[1] - averageY), p))
+
+    def update(self, foodList):
+        """
+        Catches the clusters up with the food that's there now. Eaten pellets are taken out of
+        their cluster, since it might have split in two, and pellets that show up (dropped by a
+        pacman that got eaten, or when a lookahead goes back to an earlier state) might join
+        clusters together. Only the clusters that were touched get regrouped.
+        """
+        food = set(foodList)
+        if food == self.food:
+            return
+
+        added = food - self.food
+        changed = set()
+        for pellet in self.food - food:
+            changed.add(self.clusterOf.pop(pellet))
+
+        for pellet in added:
+            if pellet not in self.links:
+                self._link(pellet)
+            for other in self.links[pellet]:
+                if other in self.clusterOf:
+                    changed.add(self.clusterOf[other])
+
+        self.food = food
+        regroup = set(added)
+        for clusterId in changed:
+            regroup |= self.clusters.pop(clusterId) & food
+            del self.centroids[clusterId]
+
+        self._group(regroup)
+
+    def largestCentroid(self):
+        """
+        Returns the centroid of the biggest cluster, or None if there's no food left.
+        """
+        if self.largest is None:
+            return None
+
+        return self.centroids[self.largest]
+
+
+class TeamRoles:
+    """
+    Which of our agents attacks and which defends. Both agents on the team share one of these
+    (it lives on their TeamBlackboard), so the roles are worked out in one place: once when
+    the game starts, and after that only when something happens that could change them, like
+    losing a capsule we were defending, a big swing in the score or one of us getting eaten.
+    `roles` maps each of our agent indexes to OFFENSE or DEFENSE, the same values as the
+    onDefense feature.
+    """
+
+    OFFENSE = 0
+    DEFENSE = 1
+
+    def __init__(self):
+        self.roles = {}
+        self.team = None
+        self._starts = {}
+        self._positions = {}
+        self._capsules = None
+        self._score = None
+
+    def register(self, agent, gameState):
+        """
+        Works out the roles at the start of the game. Only the first agent to register does
+        anything, the second one gets the same roles.
+        """
+        if self.team is not None:
+            return
+
+        self.team = agent.getTeam(gameState)
+        for index in self.team:
+            self._starts[index] = gameState.getAgentState(index).getPosition()
+            self._positions[index] = self._starts[index]
+        self._assign(agent, gameState)
+
+    def update(self, agent, gameState):
+        """
+        Checks the state an agent is about to move from and works the roles out again if we
+        lost a capsule, the score moved by ROLE_SCORE_SWING or more, or one of us got sent back
+        to the start since the last check.
+        """
+        died = False
+        for index in self.team:
+            position = gameState.getAgentState(index).getPosition()
+            if position == self._starts[index] and self._positions[index] != position:
+                died = True
+            self._positions[index] = position
+
+        capsules = len(agent.getCapsulesYouAreDefending(gameState))
+        score = agent.getScore(gameState)
+        if died or capsules != self._capsules or abs(score - self._score) >= ROLE_SCORE_SWING:
+            self._assign(agent, gameState)
+
+    def _assign(self, agent, gameState):
+        """
+        Works out every agent's role from the state.
+        """
+        # ALGORITHM GOAL: to assign each agent on the team to either offense or defense
+        # IMPLEMENTATION: goes through our team in order. The first agent in the team list is
+        # assigned to offense, next player to defense and so on. If we've lost every capsule
+        # we were defending there's nothing left to guard them for, so everyone goes on offense
+        # VARIABLES USED:
+        # count - which place in the team list the agent is in
+        # capsules - how many capsules we still have to defend
+        capsules = len(agent.getCapsulesYouAreDefending(gameState))
+        for count, index in enumerate(self.team):
+            if count % 2 == 1 and capsules > 0:
+                self.roles[index] = self.DEFENSE
+            else:
+                self.roles[index] = self.OFFENSE
+
+        self._capsules = capsules
+        self._score = agent.getScore(gameState)
+
+
+class EnemyTracker:
+    """
+    Where we think each enemy is, kept as a probability for every open cell of the
+    DistanceTable (an exact grid filter). Both agents share one of these (it lives on their
+    TeamBlackboard) and each one calls `observe` at the start of its turn with what it can see:
+
+    - the enemy that moved right before us took a step or stood still, so its belief is
+      spread evenly over the cell it was on and the cells next to it
+    - every enemy we can't see has a noisy distance reading, which rules out the cells that
+      are more than SONAR_NOISE off from it. They also can't be within SIGHT_RANGE of either
+      of us, or we'd see them
+    - food that disappeared from our side since the last update was eaten by an enemy, so
+      whoever was most likely to be there (and whose reading allows it) is put on that pellet
+    - an enemy we can see is exactly where we see it
+
+    Each of those is one pass over the cells, so an update costs O(cells) per enemy, and so
+    does `getDistance`, the expected maze distance to an enemy the features use. If the
+    readings ever rule out everywhere the enemy could have been, it got eaten and went back to
+    its start. The belief starts over there, spread over the start and the cells next to it
+    for the enemy that just moved (it had its step after coming back), and over the cells the
+    readings allow if even that doesn't fit.
+    """
+
+    def __init__(self):
+        self.table = None
+        self.beliefs = {}
+        self.starts = {}
+
+        # the cells each enemy could be on and how likely each one is, as (cell, probability)
+        # pairs, worked out after every update
+        self.support = {}
+        self._food = None
+
+    def register(self, agent, gameState, table):
+        """
+        Puts every enemy on its starting cell of the table. Only the first agent to register
+        does anything, the second one shares the same beliefs.
+        """
+        if self.table is not None:
+            return
+
+        self.table = table
+        for enemy in agent.getOpponents(gameState):
+            self.starts[enemy] = gameState.getInitialAgentPosition(enemy)
+            self._placeAt(enemy, self.starts[enemy])
+        self._food = set(agent.getFoodYouAreDefending(gameState).asList())
+
+    def observe(self, agent, gameState):
+        """
+        Updates the beliefs with what `agent` sees at the start of its turn.
+        """
+        mover = (agent.index - 1) % gameState.getNumAgents()
+        if mover in self.beliefs:
+            self._elapse(mover)
+
+        myPos = gameState.getAgentState(agent.index).getPosition()
+        teamPositions = [gameState.getAgentState(i).getPosition() for i in agent.getTeam(gameState)]
+        readings = gameState.getAgentDistances()
+
+        hidden = []
+        seen = set()
+        for enemy in self.beliefs:
+            position = gameState.getAgentState(enemy).getPosition()
+            if position is not None and position in self.table.cellIds:
+                self._placeAt(enemy, position)
+                seen.add(position)
+            else:
+                self._weigh(enemy, myPos, readings[enemy], teamPositions, enemy == mover)
+                hidden.append(enemy)
+
+        # a pellet that went missing was eaten by one of the enemies we can't see, unless we
+        # can see the one standing on it. Only an enemy whose reading fits the pellet can be
+        # on it, if none does the eater got eaten right there and already went back to start
+        food = set(agent.getFoodYouAreDefending(gameState).asList())
+        for pellet in self._food - food:
+            cell = self.table.cellIds.get(pellet)
+            if cell is None or pellet in seen:
+                continue
+            eaters = [enemy for enemy in hidden
+                    if self._possible(pellet, myPos, readings[enemy], teamPositions)]
+            if len(eaters) > 0:
+                eater = max(eaters, key = lambda enemy: (self.beliefs[enemy][cell], enemy == mover))
+                self._placeAt(eater, pellet)
+        self._food = food
+
+        for enemy in hidden:
+            self.support[enemy] = [(cell, probability)
+                    for cell, probability in enumerate(self.beliefs[enemy]) if probability > 0.0]
+
+    def getDistance(self, gameState, enemy, position):
+        """
+        Returns the maze distance from the position to the enemy if we can see it, otherwise
+        the expected distance over the cells it could be on. Infinity if it can't be reached.
+        """
+        table = self.table
+        enemyPos = gameState.getAgentState(enemy).getPosition()
+        if enemyPos is not None:
+            distance = table.getDistance(position, enemyPos)
+            return math.inf if distance is None else distance
+
+        cell = table.cellIds.get(position)
+        if cell is None:
+            return math.inf
+
+        distances = table.distances
+        row = cell * table.size
+        total = 0.0
+        weight = 0.0
+        for enemyCell, probability in self.support[enemy]:
+            distance = distances[row + enemyCell]
+            if distance != DistanceTable.UNREACHABLE:
+                total += probability * distance
+                weight += probability
+
+        if weight == 0.0:
+            return math.inf
+
+        return total / weight
+
+    def _placeAt(self, enemy, position):
+        """
+        Sets the enemy's belief to certainly being at the position.
+        """
+        belief = array('d', bytes(8 * self.table.size))
+        cell = self.table.cellIds[position]
+        belief[cell] = 1.0
+        self.beliefs[enemy] = belief
+        self.support[enemy] = [(cell, 1.0)]
+
+    def _elapse(self, enemy):
+        """
+        Moves the enemy's belief forward one move, it could have gone to any open cell next
+        to it or stayed where it was.
+        """
+        neighbors = self.table.neighbors
+        old = self.beliefs[enemy]
+        new = array('d', bytes(8 * self.table.size))
+        for cell, probability in enumerate(old):
+            if probability == 0.0:
+                continue
+            around = neighbors[cell]
+            share = probability / (len(around) + 1)
+            new[cell] += share
+            for neighbor in around:
+                new[neighbor] += share
+
+        self.beliefs[enemy] = new
+
+    def _possible(self, position, myPos, reading, teamPositions):
+        """
+        Returns if a hidden enemy could be at the position given its noisy distance reading
+        and where we are.
+        """
+        x, y = position
+        if abs(abs(x - myPos[0]) + abs(y - myPos[1]) - reading) > SONAR_NOISE:
+            return False
+        for (teamX, teamY) in teamPositions:
+            if abs(x - teamX) + abs(y - teamY) <= SIGHT_RANGE:
+                return False
+
+        return True
+
+    def _weigh(self, enemy, myPos, reading, teamPositions, moved):
+        """
+        Rules out the cells the hidden enemy can't be in and normalizes what's left. `moved`
+        says if the enemy made the move right before this update.
+        """
+        cells = self.table.cells
+        belief = self.beliefs[enemy]
+        total = 0.0
+        for cell, probability in enumerate(belief):
+            if probability == 0.0:
+                continue
+            if self._possible(cells[cell], myPos, reading, teamPositions):
+                total += probability
+            else:
+                belief[cell] = 0.0
+
+        # nowhere it could have gone fits the readings, so it must have been eaten and sent
+        # back to its start (or we lost track of it). If it moved since, it's on the start or
+        # one step off it, if nothing there fits either start over from what the readings allow
+        if total == 0.0:
+            start = self.table.cellIds[self.starts[enemy]]
+            respawned = [start]
+            if moved:
+                respawned += self.table.neighbors[start]
+            for cell in respawned:
+                if self._possible(cells[cell], myPos, reading, teamPositions):
+                    belief[cell] = 1.0
+                    total += 1.0
+            if total == 0.0:
+                for cell, position in enumerate(cells):
+                    if self._possible(position, myPos, reading, teamPositions):
+                        belief[cell] = 1.0
+                        total += 1.0
+            if total == 0.0:
+                belief[start] = 1.0
+                return
+
+        for cell in range(len(belief)):
+            belief[cell] /= total
+
+
+class FeatureVector:
+    """
+    The features of one action, with a slot for each name in FEATURE_COLUMNS. It reads and
+    writes like a counter.Counter (`features['distanceToFood'] = 3`, and anything that wasn't
+    set is 0), but the values live in one array of doubles in column order, so multiplying it
+    by a weight vector lined up the same way is a plain dot product. Names that aren't in the
+    schema raise a KeyError instead of quietly becoming a new feature.
+    """
+
+    __slots__ = ('values',)
+
+    COLUMNS = {name: column for column, name in enumerate(FEATURE_COLUMNS)}
+    ZEROS = array('d', bytes(8 * len(FEATURE_COLUMNS)))
+
+    def __init__(self):
+        self.values = self.ZEROS[:]
+
+    def __getitem__(self, name):
+        return self.values[self.COLUMNS[name]]
+
+    def __setitem__(self, name, value):
+        self.values[self.COLUMNS[name]] = value
+
+    def get(self, name, default = 0):
+        """
+        Returns the feature's value, or `default` if it isn't in the schema.
+        """
+        column = self.COLUMNS.get(name)
+        if column is None:
+            return default
+
+        return self.values[column]
+
+    def __mul__(self, weights):
+        return sum(map(operator.mul, self.values, weights))
+
+
+class MoveTimer:
+    """
+    Times our moves. chooseAction calls `start` and `stop` around each move, and checks
+    `expired` between actions (or playouts) so it stops with time left to answer. The budget
+    is the move limit minus a safety margin, None means no limit. `getStats` has how long our
+    moves took over the game.
+    """
+
+    def __init__(self, moveLimit = MOVE_TIME_LIMIT, safetyMargin = MOVE_SAFETY_MARGIN):
+        self.moveLimit = moveLimit
+        self.safetyMargin = safetyMargin
+        self.startTime = None
+        self.deadline = None
+
+        self.moves = 0
+        self.totalTime = 0.0
+        self.longestMove = 0.0
+        self.timeouts = 0
+        self._ranOut = False
+
+    def start(self):
+        """
+        Starts the clock for a new move.
+        """
+        self.startTime = time.perf_counter()
+        self._ranOut = False
+        if self.moveLimit is None:
+            self.deadline = None
+        else:
+            self.deadline = self.startTime + self.moveLimit - self.safetyMargin
+
+    def remaining(self):
+        """
+        Returns how many seconds are left for this move (infinity if there's no limit).
+        """
+        if self.deadline is None:
+            return math.inf
+
+        return max(0.0, self.deadline - time.perf_counter())
+
+    def expired(self):
+        """
+        Returns True once this move is out of time.
+        """
+        if self.deadline is None or time.perf_counter() < self.deadline:
+            return False
+
+        self._ranOut = True
+        return True
+
+    def stop(self):
+        """
+        Stops the clock and records how long the move took.
+        """
+        if self.startTime is None:
+            return
+
+        elapsed = time.perf_counter() - self.startTime
+        self.startTime = None
+        self.moves += 1
+        self.totalTime += elapsed
+        self.longestMove = max(self.longestMove, elapsed)
+        if self._ranOut:
+            self.timeouts += 1
+
+    def getStats(self):
+        """
+        Returns a dict with the number of moves timed, the average and longest move time in
+        seconds, and how many moves ran out of time.
+        """
+        average = self.totalTime / self.moves if self.moves > 0 else 0.0
+        return {'moves': self.moves, 'averageTime': average, 'longestTime': self.longestMove,
+                'timeouts': self.timeouts}
+
+
+class ZobristHasher:
+    """
+    The Zobrist hash from P4/daniel_multiagents.py, for capture states: both teams' food and
+    capsules go into it, and `successorHash` also starts over when the mover got eaten.
+    """
+
+    def __init__(self, seed = 0):
+        self._random = random.Random(seed)
+        self._keys = {}
+
+    def _key(self, *thing):
+        key = self._keys.get(thing)
+        if key is None:
+            key = self._random.getrandbits(64)
+            self._keys[thing] = key
+
+        return key
+
+    def agentHash(self, state, agent):
+        """
+        Returns the part of the hash that comes from one agent's position, direction and
+        scared timer.
+        """
+        agentState = state.getAgentState(agent)
+        return (self._key('position', agent, agentState.getPosition())
+                ^ self._key('direction', agent, agentState.getDirection())
+                ^ self._key('scared', agent, agentState.getScaredTimer()))
+
+    def hash(self, state):
+        """
+        Returns the hash of the whole state.
+        """
+        value = 0
+        for agent in range(state.getNumAgents()):
+            value ^= self.agentHash(state, agent)
+
+        for food in state.getRedFood().asList() + state.getBlueFood().asList():
+            value ^= self._key('food', food)
+
+        for capsule in state.getRedCapsules() + state.getBlueCapsules():
+            value ^= self._key('capsule', capsule)
+
+        return value
+
+    def successorHash(self, parentHash, parent, agent, successor):
+        """
+        Returns the hash of `successor`, the state after `agent` moved in `parent`.
+
+        Only the agents are rehashed, plus the pellet or capsule on the mover's new square. If
+        any agent other than the mover moved, or the mover got further than one step (someone
+        got eaten and sent back to the start), the whole state is hashed again, so whatever
+        else changes when someone gets eaten is covered too.
+        """
+        value = parentHash
+        for other in range(parent.getNumAgents()):
+            if other != agent and (parent.getAgentState(other).getPosition()
+                    != successor.getAgentState(other).getPosition()):
+                return self.hash(successor)
+
+            value ^= self.agentHash(parent, other) ^ self.agentHash(successor, other)
+
+        position = successor.getAgentState(agent).getPosition()
+        if position is None:
+            return value
+
+        previous = parent.getAgentState(agent).getPosition()
+        if previous is not None and (abs(position[0] - previous[0])
+                + abs(position[1] - previous[1]) > 1):
+            return self.hash(successor)
+
+        x, y = int(position[0]), int(position[1])
+        if (x, y) == position and parent.hasFood(x, y) and not successor.hasFood(x, y):
+            value ^= self._key('food', (x, y))
+
+        parentCapsules = parent.getRedCapsules() + parent.getBlueCapsules()
+        if position in parentCapsules and position not in (successor.getRedCapsules()
+                + successor.getBlueCapsules()):
+            value ^= self._key('capsule', position)
+
+        return value
+
+
+class SuccessorCache:
+    """
+    The successors generated during one turn, keyed by (state key, score, agent, action), so
+    the same successor is only copied once per turn no matter how many times the features or a
+    lookahead ask for it. It holds at most `capacity` of them, throwing out the one that was
+    used longest ago, and counts its hits and misses.
+
+    It also remembers the key of every successor it hands out, so asking for a successor of a
+    successor doesn't have to hash the whole state again.
+    """
+
+    def __init__(self, capacity = SUCCESSOR_CACHE_SIZE):
+        self.capacity = capacity
+        self._successors = collections.OrderedDict()
+        self._keys = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._successors)
+
+    def get(self, key):
+        """
+        Returns the successor stored for the key (and marks it as just used), or None.
+        """
+        successor = self._successors.get(key)
+        if successor is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._successors.move_to_end(key)
+        return successor
+
+    def put(self, key, successor, successorKey):
+        """
+        Stores the successor and its own state key, throwing out the least recently used one
+        if we're over capacity.
+        """
+        self._successors[key] = successor
+        self._keys[id(successor)] = (successor, successorKey)
+        if len(self._successors) > self.capacity:
+            oldest = self._successors.popitem(last = False)[1]
+            self._keys.pop(id(oldest), None)
+
+    def keyOf(self, state):
+        """
+        Returns the state key of a successor we handed out, or None if it isn't one of ours.
+        """
+        entry = self._keys.get(id(state))
+        if entry is None or entry[0] is not state:
+            return None
+
+        return entry[1]
+
+    def clear(self):
+        """
+        Empties the cache and resets the counters.
+        """
+        self._successors.clear()
+        self._keys.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def getStats(self):
+        """
+        Returns a dict with the hits, misses, hit rate and number of successors.
+        """
+        lookups = self.hits + self.misses
+        hitRate = self.hits / lookups if lookups > 0 else 0.0
+        return {'hits': self.hits, 'misses': self.misses, 'hitRate': hitRate,
+                'size': len(self._successors)}
+
+
+class TeamBlackboard:
+    """
+    Everything both of our agents would otherwise work out for themselves. createTeam makes
+    one and hands it to both agents. The first agent to register builds the layout info, the
+    distance table, the target indexes and the food clusters, and the second one just uses
+    them. The indexes are also brought up to date here, so once one of us has searched the
+    distance field for some set of food, the other one gets it for free.
+
+    The roles and the enemy tracker live here too, `startTurn` catches them up. The two of us
+    never see the same state (the other team moves in between), so each turn's own work isn't
+    shared, only the things that still hold across turns.
+    """
+
+    def __init__(self):
+        self.layoutInfo = None
+        self.distanceTable = None
+        self.foodIndex = None
+        self.capsuleIndex = None
+        self.homeIndex = None
+        self.foodClusters = None
+        self.team = None
+        self.opponents = None
+        self.teamRoles = TeamRoles()
+        self.tracker = EnemyTracker()
+        self._indexedState = None
+
+    def register(self, agent, gameState):
+        """
+        Sets up everything that only has to be worked out once per game, unless our teammate
+        already did.
+        """
+        if self.layoutInfo is None:
+            self.layoutInfo = LayoutInfo(gameState, agent.red)
+            self.distanceTable = DistanceTable(gameState.getWalls(), DISTANCE_CACHE_DIR)
+            self.team = agent.getTeam(gameState)
+            self.opponents = agent.getOpponents(gameState)
+
+            # distance fields to the closest food, capsule and spot on our border, so each of
+            # those features is one array lookup per action. The border never changes, so that
+            # one is only built here
+            self.foodIndex = TargetIndex(self.distanceTable)
+            self.capsuleIndex = TargetIndex(self.distanceTable)
+            self.homeIndex = TargetIndex(self.distanceTable, eatenOnArrival = False)
+            self.homeIndex.update(self.layoutInfo.borderCells)
+
+            # the food we're attacking, split into clusters of pellets close to each other
+            self.foodClusters = FoodClusters(agent.getFood(gameState).asList(),
+                    self.getMazeDistance)
+
+        self.teamRoles.register(agent, gameState)
+        self.tracker.register(agent, gameState, self.distanceTable)
+
+    def getMazeDistance(self, pos1, pos2):
+        """
+        Returns the maze distance from our table, or infinity if there's no path.
+        """
+        distance = self.distanceTable.getDistance(pos1, pos2)
+        if distance is None:
+            return math.inf
+
+        return distance
+
+    def startTurn(self, agent, gameState):
+        """
+        Catches up what we keep track of once per turn: the roles and where the enemies
+        probably are.
+        """
+        self.teamRoles.update(agent, gameState)
+        self.tracker.observe(agent, gameState)
+
+    def updateIndexes(self, agent, gameState):
+        """
+        Brings the food, capsule and cluster indexes up to date with the state. The work only
+        happens once per state, and the searches are only redone when the food or capsules
+        have changed.
+        """
+        if gameState is self._indexedState:
+            return
+
+        self._indexedState = gameState
+        food = agent.getFood(gameState).asList()
+        self.foodIndex.update(food)
+        self.capsuleIndex.update(agent.getCapsules(gameState))
+        self.foodClusters.update(food)
+
+
+class MCTSNode:
+    """
+    One node of MCTSAgent's search tree, reached by playing `action` from its parent. Nodes
+    don't hold on to game states, the agent replays the actions from the root to get back to
+    one, so a tree that's kept between turns is always played out from the real state. That
+    state can differ from the one the node was built from (the enemies have moved, and one
+    might have eaten us on the way), so `MCTSAgent.syncNode` checks the moves every time a
+    playout passes through.
+    """
+
+    def __init__(self, parent = None, action = None, untried = None):
+        self.parent = parent
+        self.action = action
+        self.children = {}
+
+        # legal actions we haven't made a child for yet, None until the node is first reached
+        self.untried = untried
+        self.visits = 0
+        self.totalValue = 0.0
+
+    def meanValue(self):
+        """
+        Returns the average value of the playouts that went through this node.
+        """
+        if self.visits == 0:
+            return -math.inf
+
+        return self.totalValue / self.visits
+
+
 class UngaBungaAgent(CaptureAgent):
 
     # initializes Our Ungabunga agent, nothing to fancy, don't have to make any changes to init
     def __init__(self, index, **kwargs):
         super().__init__(index)
         self.lava_floor = 0
+        self.layoutInfo = None
+        self.distanceTable = None
+        self.foodIndex = None
+        self.capsuleIndex = None
+        self.homeIndex = None
+        self.foodClusters = None
+
+        # what we share with our teammate when createTeam made us (otherwise we keep our own):
+        # the map, who's on offense and who's on defense, and where the enemies probably are
+        self.blackboard = kwargs.get('blackboard')
+        if self.blackboard is None:
+            self.blackboard = TeamBlackboard()
+        self.teamRoles = self.blackboard.teamRoles
+        self.tracker = self.blackboard.tracker
+
+        # how long each move has left, the evaluators can ask it via self.timer.remaining()
+        self.timer = MoveTimer()
+
+        # hashes game states so they can be used as cache keys
+        self.zobrist = ZobristHasher()
+        self._keyedState = None
+        self._stateKey = None
+
+        # the successors we've made this turn, see getSuccessor
+        self.successors = SuccessorCache()
+
+        # the weights laid out in FEATURE_COLUMNS order, indexed by the onDefense feature.
+        # They're fixed for the whole game, so they're built once here
+        self.weightVectors = (
+            tuple(OFFENSE_WEIGHTS.get(column, 0) for column in FEATURE_COLUMNS),
+            tuple(DEFENSE_WEIGHTS.get(column, 0) for column in FEATURE_COLUMNS),
+        )
+
+    def registerInitialState(self, gameState):
+        """
+        Sets up everything that only has to be worked out once per game. Our blackboard does
+        the work (if our teammate hasn't already), we just keep a handle on the results.
+        """
+        super().registerInitialState(gameState)
+        self.blackboard.register(self, gameState)
+        self.layoutInfo = self.blackboard.layoutInfo
+        self.distanceTable = self.blackboard.distanceTable
+        self.foodIndex = self.blackboard.foodIndex
+        self.capsuleIndex = self.blackboard.capsuleIndex
+        self.homeIndex = self.blackboard.homeIndex
+        self.foodClusters = self.blackboard.foodClusters
+
+    def startTurn(self, gameState):
+        """
+        Starts the clock on our move and catches up the things we keep track of once per
+        turn: the roles and where the enemies probably are. The features just read them.
+        """
+        self.timer.start()
+        self.successors.clear()
+        self.blackboard.startTurn(self, gameState)
+
+    def updateIndexes(self, gameState):
+        """
+        Brings the food, capsule and cluster indexes up to date with the state we're picking
+        an action from. The features call this for every action, our blackboard makes sure the
+        work only happens once per state.
+        """
+        self.blackboard.updateIndexes(self, gameState)
+
+    def getStateKey(self, gameState):
+        """
+        Returns the Zobrist hash of the state. The last state's hash is remembered, and so are
+        the hashes of the successors we made this turn, so asking for those costs nothing.
+        """
+        key = self.successors.keyOf(gameState)
+        if key is not None:
+            return key
+
+        if gameState is not self._keyedState:
+            self._keyedState = gameState
+            self._stateKey = self.zobrist.hash(gameState)
+
+        return self._stateKey
+
+    def getSuccessor(self, gameState, agent, action):
+        """
+        Same as `gameState.generateSuccessor(agent, action)`, but each successor is only made
+        once per turn.
+        """
+        stateKey = self.getStateKey(gameState)
+        key = (stateKey, gameState.getScore(), agent, action)
+        successor = self.successors.get(key)
+        if successor is None:
+            successor = gameState.generateSuccessor(agent, action)
+            self.successors.put(key, successor,
+                    self.zobrist.successorHash(stateKey, gameState, agent, successor))
+
+        return successor
+
+    def getLegalActions(self, gameState):
+        """
+        Same as `gameState.getLegalActions(self.index)`, but looked up in the distance table's
+        move lists instead of worked out from the walls. Anything the table doesn't know about
+        is handed to the game state.
+        """
+        if self.distanceTable is not None:
+            actions = self.distanceTable.getLegalActions(
+                    gameState.getAgentState(self.index).getPosition())
+            if actions is not None:
+                return actions
+
+        return gameState.getLegalActions(self.index)
+
+    def distanceHome(self, position):
+        """
+        Returns the maze distance from the position to the closest cell on our side of the
+        border, which is how far we'd have to run to be safe from the ghosts.
+        """
+        return self.homeIndex.nearestFrom(position)
+
+    def getMazeDistance(self, pos1, pos2):
+        """
+        Same as `CaptureAgent.getMazeDistance`, but reads from our precomputed table. Anything
+        the table doesn't know about is handed to the regular distancer.
+        """
+        if self.distanceTable is not None:
+            distance = self.distanceTable.getDistance(pos1, pos2)
+            if distance is not None:
+                return distance
+
+        return super().getMazeDistance(pos1, pos2)
+
+    def evaluateActions(self, gameState, actions):
+        """
+        Scores the actions one at a time with `evaluate` and returns a dictionary of action to
+        score. Stops early (after at least one action) if the timer runs out.
+        """
+        # ALGORITHM GOAL: to score as many actions as we have time for
+        # IMPLEMENTATION: a plain loop over evaluate, so there's only one place that turns
+        # features and weights into a score. Before each action after the first we check the
+        # timer, and whatever we didn't get to is left out of the dictionary.
+        # VARIABLES USED:
+        # scores - a dictionary of action to score, for the actions we got to
+        scores = {}
+        for action in actions:
+            if len(scores) > 0 and self.timer.expired():
+                break
+            scores[action] = self.evaluate(gameState, action)
+
+        return scores
 
     # takes a list of legal actions, and chooses the action that maximizes score based on the
     # current features the agent has. Scores are calculated by multiplying features by weights
@@ -46,23 +1347,23 @@ class UngaBungaAgent(CaptureAgent):
         # legal moves - takes all the available moves
         # scores - a dictionary that keeps track of our scores
         # bestActions - a list that keeps track of the highest scoring actions
-        # takes all the available legal moves
-        legalMoves = gameState.getLegalActions(self.index)
-        scores = {}
+        # takes all the available legal moves (out of our distance table, see getLegalActions)
+        legalMoves = self.getLegalActions(gameState)
         bestActions = []
 
-        # ALGORITHM GOAL: to loop through available actions and evaluate the actions value
-        # IMPLEMENTATION: Calls our list of legalMoves and iterates through each action. Each
-        # action is then assigned to our scores dictionary with its given value.
+        # ALGORITHM GOAL: to evaluate the value of every available action
+        # IMPLEMENTATION: Hands our whole list of legalMoves to evaluateActions, which scores
+        # them one by one with evaluate and gives back our scores dictionary.
         # VARIABLES USED:
-        # action - holds the current action as we iterate through legalMoves
         # legalMoves - a list of all available moves
         # scores - a dictionary that keeps track of scores
         # FUNCTIONS CALLED:
-        # self.evaluate - takes a given state and action and evaluates their value using
-        # weights and features
-        for action in legalMoves:
-            scores[action] = self.evaluate(gameState, action)
+        # self.evaluateActions - takes a given state and its actions and evaluates their
+        # values using weights and features
+        # If we run out of time before every action is scored, we go with the best of the ones
+        # we did get to (we always score at least one)
+        self.startTurn(gameState)
+        scores = self.evaluateActions(gameState, legalMoves)
 
         # ALGORITHM GOAL: to check which action(s) in the dictionary has the highest value(s)
         # IMPLEMENTATION: Calls our dictionary of scores and iterates through each key. We
@@ -88,6 +1389,7 @@ class UngaBungaAgent(CaptureAgent):
         # RETURNED: Now that we have a list of bestActions available, we return it to our
         # agent. We use random.choice so that if the list has more than one available best
         # action, we choose one randomly as a tiebreaker
+        self.timer.stop()
         return random.choice(bestActions)
 
     def evaluate(self, gameState, action):
@@ -95,119 +1397,53 @@ class UngaBungaAgent(CaptureAgent):
         Computes a linear combination of features and feature weights.
         """
         # INITIALIZING VARIABLES:
-        # features - a dictionary that holds our features given an action
-        # weights - a dictionary that holds our weights per feature
+        # features - a FeatureVector that holds our features given an action
+        # weights - a vector that holds our weights per feature
         # FUNCTIONS CALLED:
-        # self.getFeatures - returns a dictionary of features given a state and action
-        # self.getWeights - returns a dictionary of weights given a state and action
+        # self.getFeatures - returns a FeatureVector of features given a state and action
+        # self.getWeights - returns the weight vector given a state and action, we hand
+        # it the features we just computed so that getFeatures (which generates a successor
+        # and advances the lava_floor counter) only runs once per action
         features = self.getFeatures(gameState, action)
-        weights = self.getWeights(gameState, action)
+        weights = self.getWeights(gameState, action, features)
 
         # RETURNED: Now that we have our features and weights we multiply them and add them
-        # together to return a value. When you multiply two dictionaries together, we multiply
-        # the values in similar keys. EX: if key 'onDefense' is in features AND in
-        # weights, then their values are multiplied. These multiplied values are then summed
-        # together and returned.
+        # together to return a value. Both are laid out in FEATURE_COLUMNS order, so we
+        # multiply the values in the same column. EX: the 'onDefense' feature is multiplied
+        # by the 'onDefense' weight. These multiplied values are then summed together and
+        # returned.
         return features * weights
 
     def getFeatures(self, gameState, action):
         """
         Given an agent, their successor actions, and potential conditions fulfilled, returns
-        a dictionary of features.
+        a FeatureVector of features.
         """
         # INITIALIZING VARIABLES:
-        # features - a dictionary that holds our features given an action, originally
+        # features - a FeatureVector that holds our features given an action, originally
         # initialized with zero's
         # successor - returns a state given an agent and action
         # myState - an agents state given a successor state
         # myPos - an agents coordinates in (x,y) format for that successor state
         # features['onDefense] - tells the agent whether they are playing offense (0) or
-        # playing defense (1), defaults to offense so that we always have at least one attacker
-        # currentTeam - a list of agents (and their indexes) on our agent's team
-        # aSide - a list of agents that will be playing offense (0)
-        # bSide - a list of agents that will be playing defense (1)
-        features = counter.Counter()
-        successor = gameState.generateSuccessor(self.index, action)
+        # playing defense (1), read from the roles our TeamRoles worked out
+        self.updateIndexes(gameState)
+        features = FeatureVector()
+        successor = self.getSuccessor(gameState, self.index, action)
         features['successorScore'] = self.getScore(successor)
         myState = successor.getAgentState(self.index)
         myPos = myState.getPosition()
-        features['onDefense'] = 0
-        currentTeam = self.getTeam(gameState)
-
-        aSide = []
-        bSide = []
-
-        # ALGORITHM GOAL: to assign each agent on the team to either offense or defense
-        # IMPLEMENTATION: creates a while loop that iterates through our team. Count keeps
-        # track of which agent in the team list we're on. Since our indexes for each agent
-        # will be varying numbers, we keep track of their placement on the team to assign
-        # them to offense or defense. The first agent in the currentTeam list is assigned
-        # to offense, next player to defense and so on. We use a modulo to check if which
-        # index they're in to keep track of players being sent to offense or defense. After
-        # being added to either aSide or bSide, the features of the agent are updated.
-        # VARIABLES USED:
-        # count - integer that will keep track of which index the agent is on
-        # teamLength - length of the team
-        # bSide - our list of defense agents
-        # aSide - our list of offense agents
-        count = 1
-        while count <= len(currentTeam):
-            if count % 2 == 0:
-                bSide.append(currentTeam[count - 1])
-            else:
-                aSide.append(currentTeam[count - 1])
-            count += 1
+        features['onDefense'] = self.teamRoles.roles[self.index]
 
-        if self.index in aSide:
-            features['onDefense'] = 0
-        else:
-            features['onDefense'] = 1
-
-        # ALGORITHM GOAL: to create a variable that keeps track of our teams food vs their team
-        # and to get the X and Y values of the entire map
-        # IMPLEMENTATION: initializes the food positions - since each bit of the map either has
-        # food or doesn't, we can use the x and y values to create a layout. We create a for
-        # loop that will iterate through our foodPosition, incrementing X for each x value,
-        # and incrementing y for each y value. Since our foodlist is actually a grid, we can
-        # find the X by the length of each row so we just increase x by 1 for each row(foods)
-        # We then find Y by the number of rows so we increase y for each row iterated.
+        # ALGORITHM GOAL: to get the X and Y values of the entire map
+        # IMPLEMENTATION: the map never changes during a game, so the sizes are worked out once
+        # in registerInitialState (see LayoutInfo) and we just read them here instead of
+        # walking the whole food grid for every action.
         # VARIABLES USED:
-        # ourFoodPosition - a grid of all our food positions
-        # foods - holds the current food as we iterate through ourFoodPosition
-        # theirFoodPosition - a grid of all of our enemy's food positions
-        # ourFoodCount - an integer that keeps track of amount of our food at each state
-        # theirFoodCount - an integer that keeps track of amount of enemy food at each state
-        # layoutX - keeps track of largest X in map, initially set to -2 since each layout
-        # has an x on each side that is unreachable by all agents/food
-        # layoutY - keeps track of largest Y in map, initially set to -2 since each layout
-        # has an y on each side that is unreachable by all agents/food
-        # ourFoodMore or Equal - a boolean that returns whether or not we have more food than
-        # the opposing team
-        ourFoodPosition = self.getFoodYouAreDefending(gameState)
-        theirFoodPosition = self.getFood(gameState)
-        ourFoodCount = 0
-        theirFoodCount = 0
-        layoutX = -2
-
-        capsule = self.getCapsulesYouAreDefending(gameState)
-        if len(capsule) == 0:
-            features['onDefense'] = 0
-
-        for foods in ourFoodPosition:
-            layoutX += 1
-            layoutY = -2
-            for food in foods:
-                layoutY += 1
-                if str(food) == "True":
-                    ourFoodCount += 1
-
-        for foods in theirFoodPosition:
-            for food in foods:
-                if str(food) == "True":
-                    theirFoodCount += 1
-
-        # CURRENTLY NOT BEING USED
-        # ourFoodMoreOrEqual = ourFoodCount >= theirFoodCount
+        # layoutX - largest X in map (not counting the outer walls)
+        # layoutY - largest Y in map (not counting the outer walls)
+        layoutX = self.layoutInfo.layoutX
+        layoutY = self.layoutInfo.layoutY
 
         # Add map layout X and Y so that we can tell what part of the map we're in
         # based on coordinates
@@ -228,46 +1464,56 @@ class UngaBungaAgent(CaptureAgent):
 
         if features.get("onDefense") == 0:
 
-            #compute distance from DangerousEnemies
-            enemies = [successor.getAgentState(i) for i in self.getOpponents(successor)]
-            DangerEnemies = [a for a in enemies if a.isGhost() and a.getPosition() is not None]
+            #compute distance from DangerousEnemies. Enemies we can't see count with the
+            #distance our tracker expects them to be at, so the feature doesn't vanish
+            opponents = self.blackboard.opponents
+            DangerEnemies = [i for i in opponents if successor.getAgentState(i).isGhost()]
             
             if len(DangerEnemies) > 0:
-                dists = [self.getMazeDistance(myPos, a.getPosition()) for a in DangerEnemies]
+                dists = [self.tracker.getDistance(successor, i, myPos) for i in DangerEnemies]
                 features['DangerousEnemyDistance'] = sum(dists)/len(dists)
                 features['closestEnemy'] = min(dists)
 
-            # Compute distance to the nearest food.
-            foodList = self.getFood(successor).asList()            
+            # If a ghost that can eat us is closing in while we're on their side, run for the
+            # closest spot on our side of the border. The home index already knows how far
+            # that is from every cell, so it's one lookup
+            braveDists = [self.tracker.getDistance(successor, i, myPos) for i in DangerEnemies
+                    if not successor.getAgentState(i).isScaredGhost()]
+            if (not self.layoutInfo.isHome(myPos) and len(braveDists) > 0
+                    and min(braveDists) <= RETREAT_DISTANCE):
+                distanceHome = self.distanceHome(myPos)
+                if distanceHome is not None:
+                    features['distanceHome'] = distanceHome
 
-            if len(foodList) > 0:
-                myPos = successor.getAgentState(self.index).getPosition()
-                minDistance = min([self.getMazeDistance(myPos, food) for food in foodList])
-                features['distanceToFood'] = minDistance
+            # Compute distance to the nearest food. The food index already knows how far every
+            # cell is from the closest pellet, so this is one lookup instead of a distance to
+            # every pellet on the map
+            distanceToFood = self.foodIndex.nearestFrom(myPos)
+            if distanceToFood is not None:
+                features['distanceToFood'] = distanceToFood
 
             # Compute distance to nearest Capsule
-            capsules = self.getCapsules(successor)
+            distanceToCapsule = self.capsuleIndex.nearestFrom(myPos)
+            if distanceToCapsule is not None:
+                features['distanceToCapsule'] = distanceToCapsule
 
-            if len(capsules) > 0:
-                myPos = successor.getAgentState(self.index).getPosition()
-                minDistance = min([self.getMazeDistance(myPos, big_fruit) for big_fruit in capsules])
-                features['distanceToCapsule'] = minDistance
-
-            for food1 in foodList:
-                for food2 in foodList:
-                    ClusterDist = self.getMazeDistance(food1, food2)
-                    if ClusterDist < 3: features['foodCluster'] = ClusterDist
+            # Head towards the biggest group of pellets (pellets within 2 steps of each other)
+            # so one trip over the border can grab a lot of food
+            clusterCentroid = self.foodClusters.largestCentroid()
+            if clusterCentroid is not None:
+                features['foodCluster'] = self.getMazeDistance(myPos, clusterCentroid)
 
             
 
 
             # Check if agent is still on our side of the map AND if we currently have an
             # invader, if yes, then head straight for the invader. Divided into two "if"
-            # statements to check if we're blue or red
+            # statements to check if we're blue or red. Blue has always counted the column just
+            # past the midline as its own here (red doesn't), that's kept as a margin of 1 so
+            # the way we play doesn't change
             if self.red:
-                if myPos[0] <= layoutX / 2:
-                    enemies = [successor.getAgentState(i) for i in self.getOpponents(successor)]
-                    invaders = [a for a in enemies if a.isPacman() and a.getPosition() is not None]
+                if self.layoutInfo.isHome(myPos):
+                    invaders = [i for i in opponents if successor.getAgentState(i).isPacman()]
 
                     features['numInvaders'] = len(invaders)
 
@@ -276,7 +1522,7 @@ class UngaBungaAgent(CaptureAgent):
                     features['ourFloorIsLava'] = self.lava_floor
 
                     if len(invaders) > 0:
-                        dists = [self.getMazeDistance(myPos, a.getPosition()) for a in invaders]
+                        dists = [self.tracker.getDistance(successor, i, myPos) for i in invaders]
                         features['invaderDistance'] = min(dists)
                 else:
                     #this is so we dont want to stay on this side of the map
@@ -284,10 +1530,9 @@ class UngaBungaAgent(CaptureAgent):
 
 
             else:
-                if myPos[0] >= layoutX / 2:
+                if self.layoutInfo.isHome(myPos, margin = 1):
 
-                    enemies = [successor.getAgentState(i) for i in self.getOpponents(successor)]
-                    invaders = [a for a in enemies if a.isPacman() and a.getPosition() is not None]
+                    invaders = [i for i in opponents if successor.getAgentState(i).isPacman()]
 
                     features['numInvaders'] = len(invaders)
 
@@ -295,7 +1540,7 @@ class UngaBungaAgent(CaptureAgent):
                     features['ourFloorIsLava'] = self.lava_floor
 
                     if len(invaders) > 0:
-                        dists = [self.getMazeDistance(myPos, a.getPosition()) for a in invaders]
+                        dists = [self.tracker.getDistance(successor, i, myPos) for i in invaders]
                         features['invaderDistance'] = sum(dists)/len(dists)
                 else:
                     self.lava_floor = 0
@@ -308,10 +1553,11 @@ class UngaBungaAgent(CaptureAgent):
 
             # Computes distance to invaders and potential invaders. Invaders being agents that
             # have entered our area, and potential invaders being all enemy agents that are
-            # not currently in our area.
-            enemies = [successor.getAgentState(i) for i in self.getOpponents(successor)]
-            invaders = [a for a in enemies if a.isPacman() and a.getPosition() is not None]
-            potentialInvaders = [a for a in enemies if a.isGhost() and a.getPosition() is not None]
+            # not currently in our area. Enemies we can't see are as far as our tracker expects
+            # them to be, so we can still go after them.
+            opponents = self.blackboard.opponents
+            invaders = [i for i in opponents if successor.getAgentState(i).isPacman()]
+            potentialInvaders = [i for i in opponents if successor.getAgentState(i).isGhost()]
 
             # assigns the number of invaders and potential invaders to our features
             features['numInvaders'] = len(invaders)
@@ -321,14 +1567,9 @@ class UngaBungaAgent(CaptureAgent):
             # to do much better if they believe the line of scrimmage is one space away so
             # the distances are adjusted for it (this usually means the enemy is baited into
             # our territory)
-            if self.red:
-                if myPos[0] <= (layoutX / 2) - 1:
-                    features['inTeamSide'] = 1
-                    # features['inEnemySide'] = 0
-            else:
-                if myPos[0] >= (layoutX / 2) + 2:
-                    features['inTeamSide'] = 1
-                    # features['inEnemySide'] = 0
+            if self.layoutInfo.isHome(myPos, margin = -1):
+                features['inTeamSide'] = 1
+                # features['inEnemySide'] = 0
 
             # If our agent is currently a scared ghost, then we will kamikaze the enemy so
             # that we respawn as fast as we can.
@@ -338,13 +1579,13 @@ class UngaBungaAgent(CaptureAgent):
             # If we have invaders, we prioritize minimizing the distance between our agent and
             # the invader. THIS TAKES THE HIGHEST PRIORITY AS A DEFENDER
             if len(invaders) > 0:
-                dists = [self.getMazeDistance(myPos, a.getPosition()) for a in invaders]
+                dists = [self.tracker.getDistance(successor, i, myPos) for i in invaders]
                 features['invaderDistance'] = min(dists)
 
             # if we there are enemies on their own side of the map, we prioritize minimizing
             # the distance between our agent and potential threats
             if len(potentialInvaders) > 0:
-                dists = [self.getMazeDistance(myPos, a.getPosition()) for a in potentialInvaders]
+                dists = [self.tracker.getDistance(successor, i, myPos) for i in potentialInvaders]
                 features['potentialInvaderDistance'] = min(dists)
 
             # If stop is a potential action, we initialize it as a feature so that we can
@@ -360,10 +1601,10 @@ class UngaBungaAgent(CaptureAgent):
 
             return features
 
-    def getWeights(self, gameState, action):
+    def getWeights(self, gameState, action, features = None):
         """
-        Returns a dict of weights for the state.
-        The keys match up with the return from `ReflexCaptureAgent.getFeatures`.
+        Returns the weight vector for the state, lined up with FEATURE_COLUMNS like the
+        FeatureVector from `getFeatures`.
         """
         # MINIMIZING DISTANCES:
         # the following features are distances that we minimize so a HIGHER NEGATIVE
@@ -376,12 +1617,219 @@ class UngaBungaAgent(CaptureAgent):
         # The rest of the weights prioritize higher values
         # EX: inTeamSide: 150 - as a defender, staying in team side is worth more points than
         # going into enemy territory
-        features = self.getFeatures(gameState, action)
-        if features['onDefense'] == 0:
-            return {'successorScore': 100, 'distanceToFood': -5, 'numInvaders': -1500,
-                    'invaderDistance': -500, 'distanceToCapsule':-2, 'DangerousEnemyDistance': 1,
-                    'ourFloorIsLava': -1, 'closestEnemy':2, 'foodCluster': -2}
-        else:
-            return {'numInvaders': -1500, 'onDefense': 100, 'invaderDistance': -500,
-                    'potentialInvaderDistance': -5, 'stop': -100, 'reverse': -10,
-                    'inTeamSide': 150, 'witnessMEEEE': -1250}
\ No newline at end of file
+        # The weights themselves are OFFENSE_WEIGHTS and DEFENSE_WEIGHTS at the top of the
+        # file, turned into vectors once when the agent is made. The vector is picked from the
+        # features' onDefense value. evaluate passes in the features it already has, we only
+        # compute them here if we're called on our own.
+        if features is None:
+            features = self.getFeatures(gameState, action)
+        return self.weightVectors[int(features['onDefense'])]
+
+
+class MCTSAgent(UngaBungaAgent):
+    """
+    An anytime Monte Carlo tree search (UCT) over our own moves. Every playout walks down the
+    tree picking children by UCB1, adds one new child, makes a few random moves from there and
+    scores where it ended up with `UngaBungaAgent.evaluate`. Playouts keep going until the
+    timer runs out, so we get as many as the move's time allows, then the most visited move is
+    played. The subtree under that move is kept, and if the next turn starts where it expected
+    we carry on from it instead of starting over.
+
+    Like the reflex agent, the other agents stand still while we search.
+    """
+
+    def __init__(self, index, **kwargs):
+        super().__init__(index, **kwargs)
+        self.root = None
+        self._rootKey = None
+
+        # lava_floor as it was when the current search started
+        self._lavaFloor = 0
+
+        # how many playouts the last move got through
+        self.playouts = 0
+
+        # the lowest and highest playout values we've seen, so UCB1 can work on a 0-1 scale
+        self._lowValue = math.inf
+        self._highValue = -math.inf
+
+    def getTreeKey(self, gameState):
+        """
+        Returns what has to match for a kept subtree to still be about the state we're in:
+        where we are, the food we're after and the capsules left.
+        """
+        return (gameState.getAgentState(self.index).getPosition(),
+                frozenset(self.getFood(gameState).asList()), tuple(self.getCapsules(gameState)))
+
+    def getTreeActions(self, gameState):
+        """
+        Returns the actions the tree branches on. Stopping never helps in a lookahead where
+        nobody else moves, so it's only kept when it's all we can do.
+        """
+        actions = [a for a in self.getLegalActions(gameState) if a != Directions.STOP]
+        if len(actions) == 0:
+            actions = [Directions.STOP]
+
+        return actions
+
+    def chooseAction(self, gameState):
+        """
+        Runs playouts until the timer runs out and returns the most visited move.
+        """
+        self.startTurn(gameState)
+
+        # evaluate keeps counters (lava_floor) that should only move on real turns, so every
+        # playout is scored from where they stood when the search started (see scorePlayout)
+        self._lavaFloor = self.lava_floor
+
+        if self.root is None or self.getTreeKey(gameState) != self._rootKey:
+            self.root = MCTSNode()
+            self._lowValue = math.inf
+            self._highValue = -math.inf
+
+        # we always get one playout in, so there's a move to pick even when we're out of time
+        self.playouts = 0
+        while self.playouts == 0 or not self.timer.expired():
+            self.playout(gameState)
+            self.playouts += 1
+
+        self.lava_floor = self._lavaFloor
+
+        best = max(self.root.children.values(),
+                key = lambda child: (child.visits, child.meanValue()))
+
+        # hang on to the subtree under the move we're making for next turn
+        self.root = best
+        self.root.parent = None
+        self._rootKey = self.getTreeKey(self.getSuccessor(gameState, self.index, best.action))
+
+        # let evaluate see the move we actually made so its counters carry on like they do for
+        # the reflex agent
+        self.evaluate(gameState, best.action)
+
+        self.timer.stop()
+        return best.action
+
+    def playout(self, gameState):
+        """
+        Runs one playout from the root: select, expand, simulate and backpropagate.
+        """
+        # ALGORITHM GOAL: walk down the tree to a node that still has moves we haven't tried
+        # IMPLEMENTATION: each step picks the child with the best UCB1 score and plays its
+        # action on the state. Every node's moves are checked against the state we replayed
+        # to first (see syncNode), so we never play a move that isn't legal anymore.
+        node = self.root
+        state = gameState
+        while not state.isOver():
+            self.syncNode(node, state)
+            if len(node.untried) > 0:
+                break
+            node = self.selectChild(node)
+            state = self.getSuccessor(state, self.index, node.action)
+
+        # ALGORITHM GOAL: add one new child for an untried move
+        lastAction = node.action
+        if not state.isOver() and len(node.untried) > 0:
+            action = node.untried.pop(random.randrange(len(node.untried)))
+            child = MCTSNode(node, action)
+            node.children[action] = child
+            node = child
+            lastAction = action
+            state = self.getSuccessor(state, self.index, action)
+
+        value = self.rollout(state, lastAction)
+        self._lowValue = min(self._lowValue, value)
+        self._highValue = max(self._highValue, value)
+
+        # ALGORITHM GOAL: every node on the way down counts this playout
+        while node is not None:
+            node.visits += 1
+            node.totalValue += value
+            node = node.parent
+
+    def syncNode(self, node, gameState):
+        """
+        Brings a node's moves in line with the state a playout got to it in. Children for
+        moves that aren't legal there are dropped, and the untried moves become the legal
+        moves that don't have a child yet. When the state is the one the node was built from
+        nothing changes.
+        """
+        actions = self.getTreeActions(gameState)
+        for action in list(node.children):
+            if action not in actions:
+                del node.children[action]
+
+        node.untried = [action for action in actions if action not in node.children]
+
+    def selectChild(self, node):
+        """
+        Returns the child with the highest UCB1 score. Values are scaled by the lowest and
+        highest playout values seen so far, since our evaluation isn't on a 0-1 scale.
+        """
+        spread = self._highValue - self._lowValue
+        if spread <= 0:
+            spread = 1
+
+        logVisits = math.log(node.visits)
+        bestScore = -math.inf
+        bestChildren = []
+        for child in node.children.values():
+            exploit = (child.meanValue() - self._lowValue) / spread
+            explore = MCTS_EXPLORATION * math.sqrt(logVisits / child.visits)
+            score = exploit + explore
+            if score > bestScore:
+                bestScore = score
+                bestChildren = [child]
+            elif score == bestScore:
+                bestChildren.append(child)
+
+        return random.choice(bestChildren)
+
+    def rollout(self, gameState, lastAction):
+        """
+        Makes up to MCTS_ROLLOUT_DEPTH random moves from the state and returns the evaluation
+        of the last one. Random moves never stop or turn around unless they have to, so the
+        playout actually goes somewhere.
+        """
+        if gameState.isOver():
+            return self.getTerminalValue(gameState)
+
+        state = gameState
+        for step in range(MCTS_ROLLOUT_DEPTH):
+            actions = self.getTreeActions(state)
+            if lastAction is not None and len(actions) > 1:
+                reverse = Directions.REVERSE.get(lastAction)
+                actions = [a for a in actions if a != reverse]
+            action = random.choice(actions)
+
+            # the last move is scored by evaluate, which looks at the state after it for us
+            if step == MCTS_ROLLOUT_DEPTH - 1:
+                return self.scorePlayout(state, action)
+
+            state = self.getSuccessor(state, self.index, action)
+            lastAction = action
+            if state.isOver():
+                return self.getTerminalValue(state)
+
+    def scorePlayout(self, gameState, action):
+        """
+        Returns evaluate's score for a playout's last move. getFeatures advances lava_floor
+        every time it sees us on our side, so it's put back first, otherwise later playouts
+        would be scored against a bigger ourFloorIsLava than earlier ones.
+        """
+        self.lava_floor = self._lavaFloor
+        return self.evaluate(gameState, action)
+
+    def getTerminalValue(self, gameState):
+        """
+        Returns the value of a finished game, scaled like the successorScore feature so it
+        sits on the same scale as our evaluation.
+        """
+        return 100 * self.getScore(gameState)
+
+
+# the agents createTeam can build, looked up by class name
+TEAM_AGENTS = {
+    'UngaBungaAgent': UngaBungaAgent,
+    'MCTSAgent': MCTSAgent,
+}